@@ -11,14 +11,20 @@ Python клиент для тестирования WebSocket соединени
 6. Декодирует и воспроизводит аудио ответ
 
 Требования:
-- pip install websockets sounddevice opuslib
+- pip install "websockets>=14" sounddevice opuslib
 - brew install opus (на macOS)
+- pip install uvloop (опционально, быстрый цикл событий на Linux/macOS)
+- pip install numba (опционально, быстрый поиск MP3 frame sync)
+- pip install orjson (опционально, быстрый разбор JSON сообщений)
 """
 
 import asyncio
 import ctypes
 import ctypes.util
+import functools
 import json
+import logging
+import struct
 import time
 import websockets
 
@@ -30,7 +36,8 @@ except ImportError:
     )
 
 try:
-    from opuslib import Encoder, Decoder
+    from opuslib import Encoder, Decoder, OpusError, SIGNAL_VOICE
+    from opuslib.api.decoder import libopus_decode
 except Exception as exc:
     opus_path = ctypes.util.find_library("opus")
     hint = (
@@ -41,6 +48,225 @@ except Exception as exc:
     )
     raise RuntimeError(f"{hint}\nDetected opus path: {opus_path}") from exc
 
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+log = logging.getLogger(__name__)
+
+
+# Заголовок BinaryProtocol3: type:u8, reserved:u8, payload_size:u16 (big-endian)
+BP3_HEADER = struct.Struct(">BBH")
+
+
+def pack_bp3_batch(frames: list[bytes]) -> bytes:
+    """
+    Упаковывает несколько Opus кадров в одно бинарное сообщение.
+    
+    Каждый кадр идет со своим BP3 заголовком, сервер разбирает цепочку обратно на пакеты.
+    """
+    return b"".join(BP3_HEADER.pack(0, 0, len(frame)) + frame for frame in frames)
+
+
+# Сигнатуры аудио форматов по первым 4 байтам сообщения (big-endian uint32):
+# (минимальная длина, маска, значение, формат, размер заголовка перед данными, описание)
+AUDIO_SIGNATURES = (
+    # "ID3" - MP3 с ID3 тегом
+    (3, 0xFFFFFF00, 0x49443300, "mp3", 0, "MP3 format (ID3 tag)"),
+    # MP3 frame sync: 0xFF и следующие 3 бита = 111
+    (2, 0xFFE00000, 0xFFE00000, "mp3", 0, "MP3 format (frame sync)"),
+    # "OggS" - Ogg Opus контейнер
+    (4, 0xFFFFFFFF, 0x4F676753, "opus", 0, "Opus format (Ogg container)"),
+    # BinaryProtocol3: type=0, reserved=0, payload_size:u16 - Opus пакет с заголовком
+    (4, 0xFFFF0000, 0x00000000, "opus", BP3_HEADER.size, "Opus format (BP3 header)"),
+)
+
+
+def detect_audio_format(message: bytes) -> tuple[str, int, str] | None:
+    """
+    Определяет формат аудио по magic bytes.
+    
+    Первые 4 байта читаются одним числом (короткое сообщение дополняется нулями справа)
+    и сравниваются с масками из AUDIO_SIGNATURES - без срезов bytes на каждую проверку.
+    Для BP3 дополнительно проверяется, что payload_size равен длине данных после заголовка.
+    Возвращает (формат, размер заголовка, описание) или None.
+    """
+    length = len(message)
+    head = int.from_bytes(message[:4], "big") << (8 * max(0, 4 - length))
+    for min_length, mask, magic, audio_format, header_size, description in AUDIO_SIGNATURES:
+        if length >= min_length and head & mask == magic:
+            # BP3: одних нулевых type/reserved мало - payload_size должен совпасть с длиной
+            if header_size and head & 0xFFFF != length - header_size:
+                continue
+            return audio_format, header_size, description
+    return None
+
+
+def _find_mp3_sync_py(buf: bytes) -> int:
+    """Поиск MP3 frame sync без numba: 0xFF ищется через bytes.find (в C), в Python только проверка второго байта."""
+    pos = buf.find(b"\xff")
+    while 0 <= pos < len(buf) - 1:
+        if buf[pos + 1] & 0xE0 == 0xE0:
+            return pos
+        pos = buf.find(b"\xff", pos + 1)
+    return -1
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _find_mp3_sync_jit(data) -> int:
+        for i in range(data.size - 1):
+            if data[i] == 0xFF and (data[i + 1] & 0xE0) == 0xE0:
+                return i
+        return -1
+
+    def find_mp3_sync(buf: bytes) -> int:
+        """
+        Возвращает смещение первого MP3 frame sync (0xFF + 3 бита 111) или -1.
+        
+        Цикл скомпилирован numba; cache=True сохраняет машинный код на диск,
+        чтобы не компилировать его заново при каждом запуске.
+        """
+        return _find_mp3_sync_jit(np.frombuffer(buf, dtype=np.uint8))
+else:
+    find_mp3_sync = _find_mp3_sync_py
+
+
+# ============================================
+# Аудио параметры и объекты, общие для всех сессий
+# ============================================
+SAMPLE_RATE = 48000  # Частота дискретизации (48 kHz - стандарт для Opus)
+CHANNELS = 1         # Моно (1 канал)
+FRAME_SIZE = SAMPLE_RATE // 50  # 20 мс кадр => 960 сэмплов при 48 kHz
+
+
+# Hello сообщение - обязательное первое сообщение при подключении
+# Оно устанавливает параметры соединения и создает сессию
+HELLO = {
+    "type": "hello",  # Тип сообщения
+    "version": 3,     # Версия протокола
+    "transport": "websocket",  # Тип транспорта
+    "features": {
+        "aec": True,   # Acoustic Echo Cancellation (подавление эха)
+        "mcp": False   # Model Context Protocol (пока не используем)
+    },
+    "audio_params": {
+        "format": "opus",      # Формат входящего аудио (от клиента к серверу)
+        "sample_rate": SAMPLE_RATE,  # Частота дискретизации
+        "channels": CHANNELS,  # Количество каналов (моно)
+        "frame_duration": 20   # Длительность кадра в миллисекундах
+    },
+    # ВАЖНО: используем "audio_format" (с подчеркиванием), а не "audioFormat"
+    # Это формат аудио для ответов от сервера (TTS)
+    "audio_format": "mp3",  # Можно выбрать "opus" или "mp3"
+}
+
+# Hello не зависит от сессии - сериализуем один раз (UTF-8 bytes)
+HELLO_JSON = json_dumps(HELLO)
+
+
+# ============================================
+# Обработчики JSON сообщений от сервера
+# ============================================
+def _on_stt(data: dict) -> None:
+    """STT (Speech-to-Text) - транскрипция речи"""
+    log.info("📝 Transcription (STT): %s", data.get("text", ""))
+
+
+def _on_llm(data: dict) -> None:
+    """LLM ответ - текст от языковой модели"""
+    log.info("🤖 LLM Response: %s", data.get("text", ""))
+
+
+def _on_hello(data: dict) -> None:
+    """Повторный Hello (может быть, если сервер переподключился)"""
+    log.info("🔄 Received Hello again: %s", data)
+
+
+def _on_system(data: dict) -> None:
+    """Системное сообщение (ошибки, уведомления)"""
+    log.info("⚙️ System message: %s", data.get("command", ""))
+
+
+def _on_unknown(data: dict) -> None:
+    """Неизвестный тип сообщения"""
+    log.warning("❓ Unknown message type: %s", data.get("type") if isinstance(data, dict) else None)
+    log.warning("   Full message: %s", data)
+
+
+# Тип сообщения -> обработчик
+MESSAGE_HANDLERS = {
+    "stt": _on_stt,
+    "llm": _on_llm,
+    "hello": _on_hello,
+    "system": _on_system,
+}
+
+
+@functools.cache
+def get_encoder() -> Encoder:
+    """
+    Opus энкодер для кодирования PCM в Opus.
+    
+    Создается один раз: opus_encoder_create выделяет внутренние таблицы,
+    пересоздавать их на каждое подключение незачем.
+    """
+    # application="audio" - для голосового аудио (не музыки)
+    encoder = Encoder(SAMPLE_RATE, CHANNELS, application="audio")
+    
+    # Настройки под голосовой поток для STT:
+    # - complexity 5 вместо 10 по умолчанию - примерно вдвое меньше CPU на кадр,
+    #   на качество речи для распознавания не влияет
+    # - signal=voice - подсказка энкодеру, что это речь
+    # - 24 kbps VBR без ограничения - в ~2.5 раза меньше трафика, чем по умолчанию
+    encoder.complexity = 5
+    encoder.signal = SIGNAL_VOICE
+    encoder.bitrate = 24000
+    encoder.vbr = 1
+    encoder.vbr_constraint = 0
+    return encoder
+
+
+@functools.cache
+def get_decoder() -> Decoder:
+    """
+    Opus декодер для декодирования Opus в PCM.
+    
+    Создается один раз (но если сервер отправляет MP3, декодер не понадобится).
+    """
+    return Decoder(SAMPLE_RATE, CHANNELS)
+
+
+@functools.cache
+def get_output_stream() -> sd.RawOutputStream:
+    """
+    Поток для вывода звука (воспроизведение).
+    
+    Открытие устройства PortAudio занимает миллисекунды, поэтому поток открывается
+    один раз, а между сессиями только останавливается (stop), но не закрывается.
+    """
+    # RawOutputStream - сырой поток без дополнительной обработки
+    return sd.RawOutputStream(
+        samplerate=SAMPLE_RATE,
+        channels=CHANNELS,
+        dtype="int16",  # 16-битные целые числа (стандарт для PCM)
+        blocksize=0,     # Размер блока выбирает PortAudio (оптимальный для устройства)
+        latency="low",   # Минимальная задержка воспроизведения
+    )
+
 
 async def robot_client():
     """
@@ -53,67 +279,67 @@ async def robot_client():
     
     # Подключаемся к WebSocket серверу
     # async with - это контекстный менеджер, который автоматически закроет соединение
-    async with websockets.connect(uri) as websocket:
+    # compression=None: Opus/MP3 уже сжаты, permessage-deflate только тратит CPU и память
+    # max_size=4 MiB: MP3 ответ TTS приходит одним сообщением и может превышать 1 MiB по умолчанию
+    # write_limit=64 KiB: держим буфер записи небольшим, чтобы не копить задержку
+    # max_queue=None: библиотека не тормозит чтение на пачке TTS кадров,
+    # ограничение задает очередь воспроизведения play_queue
+    async with websockets.connect(
+        uri,
+        compression=None,
+        max_size=2**22,
+        max_queue=None,
+        write_limit=2**16,
+    ) as websocket:
         # ============================================
         # Настройка аудио параметров
         # ============================================
-        sample_rate = 48000  # Частота дискретизации (48 kHz - стандарт для Opus)
-        channels = 1         # Моно (1 канал)
-        frame_size = sample_rate // 50  # 20 мс кадр => 960 сэмплов при 48 kHz
         record_seconds = 5   # Записываем 5 секунд аудио
+        batch_frames = 5     # Кадров в одном WebSocket сообщении (5 x 20 мс = 100 мс)
         
-        # Создаем Opus энкодер для кодирования PCM в Opus
-        # application="audio" - для голосового аудио (не музыки)
-        encoder = Encoder(sample_rate, channels, application="audio")
+        # Энкодер, декодер и поток вывода создаются один раз на процесс,
+        # для новой сессии сбрасываем только состояние кодеков
+        encoder = get_encoder()
+        encoder.reset_state()
+        decoder = get_decoder()
+        decoder.reset_state()
         
-        # Создаем Opus декодер для декодирования Opus в PCM
-        # (но если сервер отправляет MP3, декодер не понадобится)
-        decoder = Decoder(sample_rate, channels)
+        # PCM буфер для декодера выделяется один раз и переиспользуется для каждого кадра
+        # (Decoder.decode создает новый bytes на каждый вызов)
+        pcm_buf = bytearray(FRAME_SIZE * CHANNELS * 2)  # int16 = 2 байта на сэмпл
+        pcm_out = (ctypes.c_int16 * (FRAME_SIZE * CHANNELS)).from_buffer(pcm_buf)
+        pcm_view = memoryview(pcm_buf)
         
-        # Создаем поток для вывода звука (воспроизведение)
-        # RawOutputStream - сырой поток без дополнительной обработки
-        output_stream = sd.RawOutputStream(
-            samplerate=sample_rate,
-            channels=channels,
-            dtype="int16",  # 16-битные целые числа (стандарт для PCM)
-            blocksize=frame_size,  # Размер блока для буферизации
-        )
-        output_stream.start()  # Запускаем поток вывода
+        def decode_opus(packet: bytes) -> memoryview:
+            """
+            Декодирует Opus пакет в общий PCM буфер.
+            
+            Возвращает срез буфера с декодированными сэмплами. Срез действителен
+            до следующего вызова, поэтому его нужно сразу отдать в output_stream.
+            """
+            samples = libopus_decode(
+                decoder.decoder_state, packet, len(packet), pcm_out, FRAME_SIZE, 0
+            )
+            if samples < 0:
+                raise OpusError(samples)
+            return pcm_view[:samples * CHANNELS * 2]
+        
+        output_stream = get_output_stream()
         
         # ============================================
         # ШАГ 1: Отправка Hello сообщения
         # ============================================
-        # Hello сообщение - обязательное первое сообщение при подключении
-        # Оно устанавливает параметры соединения и создает сессию
-        hello = {
-            "type": "hello",  # Тип сообщения
-            "version": 3,     # Версия протокола
-            "transport": "websocket",  # Тип транспорта
-            "features": {
-                "aec": True,   # Acoustic Echo Cancellation (подавление эха)
-                "mcp": False   # Model Context Protocol (пока не используем)
-            },
-            "audio_params": {
-                "format": "opus",      # Формат входящего аудио (от клиента к серверу)
-                "sample_rate": 48000,  # Частота дискретизации
-                "channels": 1,         # Количество каналов (моно)
-                "frame_duration": 20   # Длительность кадра в миллисекундах
-            },
-            # ВАЖНО: используем "audio_format" (с подчеркиванием), а не "audioFormat"
-            # Это формат аудио для ответов от сервера (TTS)
-            "audio_format": "mp3",  # Можно выбрать "opus" или "mp3"
-        }
-        
-        # Отправляем Hello сообщение как JSON строку
-        await websocket.send(json.dumps(hello))
-        print(f"✅ Sent Hello message with audio_format: {hello['audio_format']}")
+        # HELLO_JSON сериализован один раз при импорте модуля
+        # Отправляем как текстовый фрейм: сервер принимает Hello только в Text сообщении
+        await websocket.send(HELLO_JSON, text=True)
+        print(f"✅ Sent Hello message with audio_format: {HELLO['audio_format']}")
         
         # ============================================
         # ШАГ 2: Получение ответа Hello
         # ============================================
         # Сервер должен ответить Hello сообщением с session_id
         response = await websocket.recv()
-        hello_response = json.loads(response)
+        hello_response = json_loads(response)
         
         # Проверяем, что это действительно Hello ответ
         if hello_response.get("type") != "hello":
@@ -124,7 +350,7 @@ async def robot_client():
         
         # Проверяем, какой формат аудио будет использовать сервер
         # Это формат, который мы запросили в Hello сообщении
-        server_audio_format = hello_response.get("audio_format", hello.get("audio_format", "opus"))
+        server_audio_format = hello_response.get("audio_format", HELLO.get("audio_format", "opus"))
         print(f"📦 Server will send audio in format: {server_audio_format}")
         
         # ============================================
@@ -138,82 +364,137 @@ async def robot_client():
             Асинхронная функция для записи аудио с микрофона и отправки на сервер.
             
             Процесс:
-            1. Открываем поток ввода с микрофона
-            2. Читаем PCM сэмплы блоками по 20 мс
-            3. Кодируем PCM в Opus
-            4. Отправляем Opus кадры на сервер через WebSocket
+            1. Открываем поток ввода с микрофона с callback
+            2. PortAudio вызывает callback в своем потоке на каждый кадр 20 мс
+            3. Callback кодирует PCM в Opus и кладет кадр в asyncio.Queue
+            4. Корутина ждет кадры из очереди и отправляет их на сервер пачками по 100 мс
             """
+            loop = asyncio.get_running_loop()
+            opus_queue: asyncio.Queue = asyncio.Queue()  # Opus кадры от callback (None - ошибка)
             last_overflow_log = 0.0  # Время последнего предупреждения о переполнении
-            frames: list[bytes] = []  # Список для накопления PCM кадров
+            batch: list[bytes] = []  # Кадры, ожидающие отправки одним сообщением
+            sent_frames = 0  # Количество отправленных кадров
+            
+            def audio_cb(indata, frame_count, time_info, status):
+                """
+                Callback PortAudio: вызывается в потоке аудио драйвера, а не в цикле событий.
+                
+                Поэтому кадр передается в очередь только через call_soon_threadsafe.
+                """
+                nonlocal last_overflow_log
+                
+                # Если произошло переполнение, выводим предупреждение (не чаще раза в 5 секунд)
+                if status.input_overflow and time.time() - last_overflow_log > 5.0:
+                    print("⚠️ Audio input overflowed - some audio may be lost")
+                    last_overflow_log = time.time()
+                
+                try:
+                    # indata - cffi buffer, приводим к bytes (единственная копия кадра)
+                    # FRAME_SIZE - размер кадра в сэмплах (960 для 20 мс при 48 kHz)
+                    opus_frame = encoder.encode(bytes(indata), frame_size=FRAME_SIZE)
+                except Exception as exc:
+                    print(f"❌ Opus encode error: {exc}")
+                    opus_frame = None
+                loop.call_soon_threadsafe(opus_queue.put_nowait, opus_frame)
+            
+            async def flush_batch() -> bool:
+                """Отправляет накопленные кадры одним сообщением. Возвращает False при ошибке."""
+                nonlocal sent_frames
+                if not batch:
+                    return True
+                try:
+                    # Отправляем пачку Opus кадров как бинарные данные через WebSocket
+                    await websocket.send(pack_bp3_batch(batch))
+                except websockets.ConnectionClosed:
+                    print("❌ WebSocket connection closed during sending")
+                    stop.set()
+                    return False
+                except Exception as exc:
+                    print(f"❌ Send audio error: {exc}")
+                    stop.set()
+                    return False
+                sent_frames += len(batch)
+                batch.clear()
+                return True
             
             # Открываем поток ввода с микрофона
+            # Чтение идет в потоке PortAudio, цикл событий просыпается только на готовых кадрах
             with sd.RawInputStream(
-                samplerate=sample_rate,
-                channels=channels,
+                samplerate=SAMPLE_RATE,
+                channels=CHANNELS,
                 dtype="int16",
-                blocksize=frame_size,
-            ) as mic:
-                start_ts = time.monotonic()  # Время начала записи
-                
+                blocksize=FRAME_SIZE,
+                callback=audio_cb,
+            ):
                 # Записываем аудио в течение record_seconds секунд
-                while not stop.is_set() and (time.monotonic() - start_ts) < record_seconds:
-                    try:
-                        # Читаем один кадр PCM аудио с микрофона
-                        # pcm_bytes - это numpy массив с аудио данными
-                        # overflowed - флаг, указывающий на переполнение буфера
-                        pcm_bytes, overflowed = mic.read(frame_size)
-                        
-                        # Если произошло переполнение, выводим предупреждение (не чаще раза в 5 секунд)
-                        if overflowed and time.time() - last_overflow_log > 5.0:
-                            print("⚠️ Audio input overflowed - some audio may be lost")
-                            last_overflow_log = time.time()
-                        
-                        # Преобразуем numpy массив в bytes
-                        # mic.read возвращает cffi buffer, нужно привести к bytes
-                        pcm_raw = bytes(pcm_bytes)
-                        frames.append(pcm_raw)
-                        
-                        # Отдаем управление циклу событий (yield)
-                        # Это важно для асинхронности - позволяет другим задачам выполняться
-                        await asyncio.sleep(0)
-                        
-                    except websockets.ConnectionClosed:
-                        # Соединение закрыто - останавливаем запись
-                        print("❌ WebSocket connection closed during recording")
-                        stop.set()
-                    except Exception as exc:
-                        print(f"❌ Send audio error: {exc}")
-                        stop.set()
+                # Конец записи отмечает один таймер, а не проверка часов на каждом кадре
+                # (отдельное событие: stop завершает и прием сообщений)
+                recording_done = asyncio.Event()
+                record_timer = loop.call_later(record_seconds, recording_done.set)
                 
-                # После записи всех кадров - кодируем и отправляем их
-                if frames:
-                    total_ms = len(frames) * 20  # Каждый кадр = 20 мс
-                    print(f"📤 Sending {len(frames)} frames (~{total_ms} ms of audio)")
-                
-                # Кодируем каждый PCM кадр в Opus и отправляем
-                for pcm_raw in frames:
-                    try:
-                        # Создаем C строковый буфер из bytes
-                        # Opus энкодер требует C буфер, а не Python bytes
-                        pcm_buf = ctypes.create_string_buffer(pcm_raw, len(pcm_raw))
-                        
-                        # Кодируем PCM в Opus
-                        # frame_size - размер кадра в сэмплах (960 для 20 мс при 48 kHz)
-                        opus_frame = encoder.encode(pcm_buf, frame_size=frame_size)
-                        
-                        # Отправляем Opus кадр как бинарные данные через WebSocket
-                        await websocket.send(opus_frame)
-                        
-                    except websockets.ConnectionClosed:
-                        print("❌ WebSocket connection closed during sending")
+                # Кадры отправляются пачками по batch_frames, пока идет запись
+                while not stop.is_set() and not recording_done.is_set():
+                    opus_frame = await opus_queue.get()
+                    if opus_frame is None:
                         stop.set()
                         break
-                    except Exception as exc:
-                        print(f"❌ Send audio error: {exc}")
-                        stop.set()
+                    
+                    batch.append(opus_frame)
+                    if len(batch) >= batch_frames and not await flush_batch():
                         break
                 
-                print("✅ Finished sending audio")
+                record_timer.cancel()
+            
+            # Досылаем неполную последнюю пачку
+            if not stop.is_set():
+                await flush_batch()
+            
+            total_ms = sent_frames * 20  # Каждый кадр = 20 мс
+            print(f"📤 Sent {sent_frames} frames (~{total_ms} ms of audio)")
+            print("✅ Finished sending audio")
+        
+        saved_audio = None  # Файл для аудио ответа, который не воспроизводим (MP3 и др.)
+        undecoded_packets: list[bytes] = []  # Opus пакеты, которые не удалось декодировать
+        
+        # Очередь Opus пакетов между приемом и воспроизведением
+        # Ограничена, чтобы декодер не отставал от сети больше чем на ~1 секунду
+        play_queue: asyncio.Queue = asyncio.Queue(maxsize=50)
+        
+        async def play_audio():
+            """
+            Асинхронная функция для декодирования и воспроизведения Opus пакетов из play_queue.
+            
+            Работает отдельной задачей: receive_messages только кладет пакеты в очередь
+            и сразу возвращается к приему, не дожидаясь декодирования.
+            None в очереди - сигнал завершения после того, как все пакеты до него сыграны.
+            """
+            while True:
+                packet = await play_queue.get()
+                if packet is None:
+                    return
+                try:
+                    # Декодируем Opus в PCM
+                    pcm = decode_opus(packet)
+                    
+                    # Воспроизводим декодированное аудио
+                    # memoryview над bytearray - sounddevice берет его через
+                    # ffi.from_buffer без копирования
+                    # write блокируется, пока PortAudio не примет данные, поэтому идет
+                    # в отдельном потоке и не держит цикл событий (прием и отправку)
+                    # Буфер pcm безопасен: следующий decode_opus только после записи
+                    await asyncio.to_thread(output_stream.write, pcm)
+                    log.debug("🔊 Playing decoded Opus audio")
+                    
+                except Exception as e:
+                    log.error("❌ Error decoding Opus: %s (audio length: %d bytes)", e, len(packet))
+                    # hex дампа считаем только если debug лог действительно включен
+                    if log.isEnabledFor(logging.DEBUG):
+                        log.debug("   First 10 bytes: %s", packet[:10].hex())
+                    
+                    # Возможно, это не Opus, а другой формат
+                    # Копим для анализа, в файл запишем один раз при закрытии
+                    # (с BP3 заголовками, чтобы границы пакетов не потерялись)
+                    undecoded_packets.append(packet)
         
         async def receive_messages():
             """
@@ -223,6 +504,10 @@ async def robot_client():
             - JSON сообщения (STT транскрипция, LLM ответы)
             - Бинарные данные (аудио ответы от TTS)
             """
+            nonlocal saved_audio
+            stream_format = None  # Формат аудио ответов (определяется по первому сообщению)
+            stream_header_size = 0  # Размер заголовка перед Opus пакетом (BP3 - 4 байта)
+            
             try:
                 while not stop.is_set():
                     # Ждем сообщение от сервера
@@ -232,144 +517,91 @@ async def robot_client():
                         # ============================================
                         # БИНАРНЫЕ ДАННЫЕ - АУДИО ОТВЕТ ОТ TTS
                         # ============================================
-                        print(f"🎵 Received audio: {len(message)} bytes")
-                        
-                        # Сначала используем формат из Hello ответа
-                        # Это самый надежный способ, так как мы сами запросили этот формат
-                        is_mp3 = (server_audio_format.lower() == "mp3")
-                        is_opus = (server_audio_format.lower() == "opus")
-                        
-                        # Дополнительно проверяем по magic bytes для подтверждения
-                        # (на случай, если сервер отправил не тот формат, что мы запросили)
-                        detected_format = None
-                        if len(message) >= 3:
-                            # MP3 файлы начинаются с:
-                            # - ID3 тег: "ID3" (первые 3 байта)
-                            # - MP3 frame sync: 0xFF 0xFB или 0xFF 0xF3 (первые 2 байта)
-                            if message[:3] == b"ID3":
-                                detected_format = "mp3"
-                                print("🔍 Detected MP3 format (ID3 tag)")
-                            elif len(message) >= 2 and message[0] == 0xFF and (message[1] & 0xE0) == 0xE0:
-                                # MP3 frame sync: 0xFF и следующие 3 бита = 111
-                                detected_format = "mp3"
-                                print("🔍 Detected MP3 format (frame sync)")
-                            elif len(message) >= 4:
-                                # Opus файлы могут начинаться с OggS (если это Ogg Opus)
-                                # или просто с Opus пакетов (TOC байт)
-                                # Проверяем на Ogg контейнер
-                                if message[:4] == b"OggS":
-                                    detected_format = "opus"
-                                    print("🔍 Detected Opus format (Ogg container)")
-                        
-                        # Если определенный формат не совпадает с запрошенным - предупреждаем
-                        if detected_format and detected_format != server_audio_format.lower():
-                            print(f"⚠️ Received {detected_format} audio, but decoder is set for {server_audio_format}")
-                            print(f"💡 Tip: Set audio_format to '{detected_format}' in Hello message to use {detected_format} decoder")
-                            # Используем определенный формат вместо запрошенного
-                            is_mp3 = (detected_format == "mp3")
-                            is_opus = (detected_format == "opus")
+                        log.debug("🎵 Received audio: %d bytes", len(message))
                         
-                        # Обрабатываем в зависимости от определенного формата
-                        if is_mp3:
-                            # MP3 формат - сохраняем в файл
-                            # Для воспроизведения MP3 в Python нужна дополнительная библиотека
-                            # (например, pydub + ffmpeg), поэтому просто сохраняем
-                            filename = "response.mp3"
-                            with open(filename, "wb") as f:
-                                f.write(message)
-                            print(f"💾 Saved MP3 audio to {filename}")
-                            print("💡 To play MP3, use: afplay response.mp3 (macOS) or mpv response.mp3 (Linux)")
+                        # Формат определяется один раз по первому аудио сообщению:
+                        # сервер не меняет формат в рамках сессии
+                        if stream_format is None:
+                            # Сначала используем формат из Hello ответа
+                            # Это самый надежный способ, так как мы сами запросили этот формат
+                            stream_format = server_audio_format.lower()
                             
-                        elif is_opus:
-                            # Opus формат - декодируем и воспроизводим
-                            try:
-                                # Декодируем Opus в PCM
-                                pcm = decoder.decode(message, frame_size=frame_size)
+                            # Дополнительно проверяем по magic bytes для подтверждения
+                            # (на случай, если сервер отправил не тот формат, что мы запросили)
+                            detected = detect_audio_format(message)
+                            if detected is None:
+                                log.warning("⚠️ Could not determine audio format by magic bytes, using requested format: %s", server_audio_format)
                                 
-                                # Воспроизводим декодированное аудио
-                                output_stream.write(pcm)
-                                print("🔊 Playing decoded Opus audio")
-                                
-                            except Exception as e:
-                                print(f"❌ Error decoding Opus: {e}")
-                                print(f"   Audio length: {len(message)} bytes")
-                                print(f"   First 10 bytes: {message[:10].hex()}")
+                                if stream_format == "mp3":
+                                    # Поток мог начаться не с границы кадра - ищем первый frame sync
+                                    # и отбрасываем мусор перед ним (только в первом сообщении)
+                                    sync_offset = find_mp3_sync(message)
+                                    if sync_offset > 0:
+                                        log.info("🔍 MP3 frame sync found at offset %d, skipping leading bytes", sync_offset)
+                                        message = message[sync_offset:]
+                            else:
+                                detected_format, stream_header_size, description = detected
+                                log.info("🔍 Detected %s", description)
                                 
-                                # Возможно, это не Opus, а другой формат
-                                # Сохраняем в файл для анализа
-                                with open("response_unknown.bin", "wb") as f:
-                                    f.write(message)
-                                print("💾 Saved unknown audio format to response_unknown.bin")
+                                # Если определенный формат не совпадает с запрошенным - предупреждаем
+                                if detected_format != stream_format:
+                                    log.warning("⚠️ Received %s audio, but decoder is set for %s", detected_format, server_audio_format)
+                                    log.warning("💡 Tip: Set audio_format to '%s' in Hello message to use %s decoder", detected_format, detected_format)
+                                    # Используем определенный формат вместо запрошенного
+                                    stream_format = detected_format
+                        
+                        # Обрабатываем в зависимости от определенного формата
+                        if stream_format == "opus":
+                            # Opus формат - передаем в очередь воспроизведения
+                            # (BP3 заголовок, если есть, отрезаем)
+                            # Декодирование и вывод идут в play_audio, прием не ждет их
+                            packet = message[stream_header_size:] if stream_header_size else message
+                            await play_queue.put(packet)
                         else:
-                            # Не удалось определить формат - используем формат из Hello
-                            print(f"⚠️ Could not determine audio format by magic bytes, using requested format: {server_audio_format}")
-                            
-                            if server_audio_format.lower() == "opus":
-                                # Пробуем декодировать как Opus
-                                try:
-                                    pcm = decoder.decode(message, frame_size=frame_size)
-                                    output_stream.write(pcm)
-                                    print("✅ Successfully decoded as Opus")
-                                except Exception as e:
-                                    print(f"❌ Error decoding as Opus: {e}")
-                                    # Сохраняем для анализа
-                                    filename = "response_opus_error.bin"
-                                    with open(filename, "wb") as f:
-                                        f.write(message)
-                                    print(f"💾 Saved to {filename} for analysis")
-                            else:
-                                # Сохраняем как MP3 (или другой формат)
-                                filename = f"response.{server_audio_format.lower()}"
-                                with open(filename, "wb") as f:
-                                    f.write(message)
-                                print(f"💾 Saved as {filename}")
-                                print(f"💡 To play, use: afplay {filename} (macOS) or mpv {filename} (Linux)")
+                            # MP3 (или другой формат) - сохраняем в файл
+                            # Для воспроизведения MP3 в Python нужна дополнительная библиотека
+                            # (например, pydub + ffmpeg), поэтому просто сохраняем
+                            # TTS может прийти несколькими сообщениями: файл открывается
+                            # на первом и дописывается, а закрывается в конце сессии
+                            if saved_audio is None:
+                                filename = f"response_{session_id}.{stream_format}"
+                                saved_audio = open(filename, "wb")
+                                log.info("💾 Saving %s audio to %s", stream_format.upper(), filename)
+                            saved_audio.write(message)
                     else:
                         # ============================================
                         # JSON СООБЩЕНИЯ - ТЕКСТОВЫЕ ОТВЕТЫ
                         # ============================================
-                        data = json.loads(message)
-                        msg_type = data.get("type")
+                        data = json_loads(message)
+                        
+                        # Обработчик выбирается одним поиском в словаре по типу сообщения
+                        # TypeError: "type" нехешируемый (список/объект) или JSON не объект
+                        try:
+                            handler = MESSAGE_HANDLERS[data["type"]]
+                        except (KeyError, TypeError):
+                            handler = _on_unknown
+                        handler(data)
                         
-                        if msg_type == "stt":
-                            # STT (Speech-to-Text) - транскрипция речи
-                            text = data.get("text", "")
-                            print(f"📝 Transcription (STT): {text}")
-                            
-                        elif msg_type == "llm":
-                            # LLM ответ - текст от языковой модели
-                            text = data.get("text", "")
-                            print(f"🤖 LLM Response: {text}")
-                            
-                        elif msg_type == "hello":
-                            # Повторный Hello (может быть, если сервер переподключился)
-                            print(f"🔄 Received Hello again: {data}")
-                            
-                        elif msg_type == "system":
-                            # Системное сообщение (ошибки, уведомления)
-                            command = data.get("command", "")
-                            print(f"⚙️ System message: {command}")
-                            
-                        else:
-                            # Неизвестный тип сообщения
-                            print(f"❓ Unknown message type: {msg_type}")
-                            print(f"   Full message: {data}")
-                            
             except websockets.ConnectionClosed:
-                print("❌ WebSocket connection closed during receive")
+                log.error("❌ WebSocket connection closed during receive")
                 stop.set()
             except Exception as exc:
-                print(f"❌ Receive error: {exc}")
+                log.error("❌ Receive error: %s", exc)
                 stop.set()
         
         # ============================================
         # Запуск параллельных задач
         # ============================================
-        # Создаем две задачи, которые выполняются параллельно:
+        # Создаем три задачи, которые выполняются параллельно:
         # 1. send_task - запись и отправка аудио
         # 2. recv_task - прием сообщений от сервера
+        # 3. play_task - декодирование и воспроизведение Opus ответа
+        # Поток вывода запускаем только после Hello: если рукопожатие сорвется,
+        # он останется остановленным и пригодится при переподключении
+        output_stream.start()  # Запускаем поток вывода
         send_task = asyncio.create_task(send_audio())
         recv_task = asyncio.create_task(receive_messages())
+        play_task = asyncio.create_task(play_audio())
         
         # Ждем завершения отправки аудио
         await send_task
@@ -389,13 +621,61 @@ async def robot_client():
             # Ждем завершения всех задач (с обработкой исключений)
             await asyncio.gather(recv_task, return_exceptions=True)
             
+            # Доигрываем то, что уже в очереди (до ~1 секунды ответа), и только потом
+            # останавливаем воспроизведение
+            try:
+                if not play_task.done():
+                    await asyncio.wait_for(play_queue.put(None), timeout=5.0)
+                await asyncio.wait_for(play_task, timeout=5.0)
+            except Exception as exc:
+                print(f"⚠️ Playback did not finish cleanly: {exc!r}")
+                play_task.cancel()
+                await asyncio.gather(play_task, return_exceptions=True)
+            
             # Останавливаем поток вывода звука
+            # Не закрываем: поток переиспользуется следующей сессией
             output_stream.stop()
-            output_stream.close()
+            
+            # Закрываем файл аудио ответа (все сообщения сессии уже дописаны)
+            if saved_audio is not None:
+                saved_audio.close()
+                log.info("💾 Saved audio to %s", saved_audio.name)
+                log.info("💡 To play, use: afplay %s (macOS) or mpv %s (Linux)", saved_audio.name, saved_audio.name)
+            
+            if undecoded_packets:
+                filename = f"response_unknown_{session_id}.bin"
+                with open(filename, "wb") as f:
+                    f.write(pack_bp3_batch(undecoded_packets))
+                log.info("💾 Saved %d undecoded packets (BP3 framed) to %s", len(undecoded_packets), filename)
             
             print("✅ Connection closed")
 
 
+async def run_with_reconnect():
+    """
+    Запускает сессию клиента и переподключается, если соединение не удалось установить.
+    
+    Энкодер, декодер, поток вывода и Hello уже подготовлены на уровне модуля,
+    поэтому повторная попытка стоит только нового WebSocket рукопожатия.
+    Пауза между попытками растет от 1 до 30 секунд.
+    Повторяются только временные сбои (сеть, обрыв, 5xx от сервера); неверный URI
+    или 4xx на рукопожатии повтором не исправить, они пробрасываются наружу.
+    """
+    backoff = 1.0
+    while True:
+        try:
+            await robot_client()
+            return
+        except websockets.InvalidStatus as exc:
+            if exc.response.status_code < 500:
+                raise
+            print(f"🔁 Server error ({exc}), retrying in {backoff:.0f}s...")
+        except (OSError, websockets.ConnectionClosed) as exc:
+            print(f"🔁 Connection failed ({exc}), retrying in {backoff:.0f}s...")
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 30.0)
+
+
 # Запускаем клиент
 if __name__ == "__main__":
     print("🚀 Starting MediaRise Robot Console WebSocket Client...")
@@ -403,8 +683,19 @@ if __name__ == "__main__":
     print("🎤 Will record 5 seconds of audio from microphone")
     print("=" * 60)
     
+    # Сообщения от сервера выводятся через logging: уровень можно поднять,
+    # чтобы заглушить клиент, или опустить до DEBUG для покадровой диагностики
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    
+    # uvloop (libuv) заметно быстрее стандартного цикла событий на send/recv
+    # На Windows его нет - там остается стандартный ProactorEventLoop
+    try:
+        from uvloop import run as run_loop
+    except ImportError:
+        run_loop = asyncio.run
+    
     try:
-        asyncio.run(robot_client())
+        run_loop(run_with_reconnect())
     except KeyboardInterrupt:
         print("\n⚠️ Interrupted by user")
     except Exception as e:
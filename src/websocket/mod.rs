@@ -25,19 +25,54 @@ const SERVER_OPUS_CHANNELS: u32 = 1;
 const SERVER_OPUS_FRAME_DURATION_MS: u32 = OPUS_FRAME_SIZE_MS as u32;
 const STREAMING_FRAME_DELAY_MS: u64 = SERVER_OPUS_FRAME_DURATION_MS as u64;
 
-fn try_strip_bp3_header(data: &[u8]) -> (&[u8], bool) {
-    if data.len() < 4 {
-        return (data, false);
+/// Разбирает бинарное сообщение как последовательность BP3 фреймов.
+///
+/// Клиент может упаковать несколько Opus пакетов в одно сообщение, чтобы не платить
+/// за WebSocket фрейм на каждые 20 мс. Возвращает `None`, если сообщение не является
+/// корректной цепочкой BP3 фреймов (тогда это сырые данные без заголовка).
+fn split_bp3_frames(data: &[u8]) -> Option<Vec<&[u8]>> {
+    let mut frames = Vec::new();
+    let mut rest = data;
+    while !rest.is_empty() {
+        if rest.len() < 4 {
+            return None;
+        }
+        // BinaryProtocol3: { type:u8, reserved:u8, payload_size:u16(be), payload... }
+        if rest[0] != 0 || rest[1] != 0 {
+            return None;
+        }
+        let payload_size = u16::from_be_bytes([rest[2], rest[3]]) as usize;
+        if payload_size > rest.len() - 4 {
+            return None;
+        }
+        frames.push(&rest[4..4 + payload_size]);
+        rest = &rest[4 + payload_size..];
     }
-    // BinaryProtocol3: { type:u8, reserved:u8, payload_size:u16(be), payload... }
-    if data[0] != 0 || data[1] != 0 {
-        return (data, false);
+    if frames.is_empty() {
+        None
+    } else {
+        Some(frames)
     }
-    let payload_size = u16::from_be_bytes([data[2], data[3]]) as usize;
-    if payload_size != data.len() - 4 {
-        return (data, false);
+}
+
+/// Декодирует пакеты BP3 цепочки по отдельности в общий PCM буфер.
+///
+/// Битый пакет логируется и пропускается, чтобы не терять остальные кадры пачки.
+fn decode_bp3_packets(processor: &mut AudioProcessor, packets: &[&[u8]]) -> Vec<i16> {
+    let mut pcm_samples = Vec::new();
+    for (index, packet) in packets.iter().enumerate() {
+        match processor.process_incoming_audio(packet) {
+            Ok(samples) => pcm_samples.extend(samples),
+            Err(e) => warn!(
+                "Skipping undecodable BP3 packet {}/{} ({} bytes): {}",
+                index + 1,
+                packets.len(),
+                packet.len(),
+                e
+            ),
+        }
     }
-    (&data[4..], true)
+    pcm_samples
 }
 
 fn frame_bp3(payload: &[u8]) -> anyhow::Result<Vec<u8>> {
@@ -495,21 +530,30 @@ pub async fn handle_connection(
                 }
             }
             Ok(WsMessage::Binary(data)) => {
-                let (payload, stripped_bp3) = try_strip_bp3_header(&data);
-                if stripped_bp3 {
-                    info!(
-                        "Received binary audio data: {} bytes (BP3 framed -> {} bytes payload)",
+                let bp3_packets = split_bp3_frames(&data);
+                match &bp3_packets {
+                    Some(frames) => info!(
+                        "Received binary audio data: {} bytes (BP3 framed -> {} packets, {} bytes payload)",
                         data.len(),
-                        payload.len()
-                    );
-                } else {
-                    info!("Received binary audio data: {} bytes", data.len());
+                        frames.len(),
+                        frames.iter().map(|f| f.len()).sum::<usize>()
+                    ),
+                    None => info!("Received binary audio data: {} bytes", data.len()),
                 }
 
                 // Обрабатываем аудио данные
                 if let Some(ref mut processor) = audio_processor {
                     info!("Audio processor available, trying to decode audio...");
-                    match processor.process_incoming_audio(payload) {
+                    // Fallback на сырой STT только для сообщений без BP3 цепочки:
+                    // в пачке битые пакеты пропускаются, а не уходят в STT с заголовками
+                    let decoded = match &bp3_packets {
+                        Some(packets) => Ok(decode_bp3_packets(processor, packets)),
+                        None => processor.process_incoming_audio(&data),
+                    };
+                    match decoded {
+                        Ok(pcm_samples) if pcm_samples.is_empty() => {
+                            warn!("No decodable Opus packets in binary message, skipping");
+                        }
                         Ok(pcm_samples) => {
                             info!("Decoded audio to PCM: {} samples", pcm_samples.len());
                             
@@ -576,7 +620,7 @@ pub async fn handle_connection(
                             info!(
                                 "Trying to send raw audio to STT (may be WebM format from browser)"
                             );
-                            match handle_raw_audio(&services, &session_id, payload, &mut sender).await
+                            match handle_raw_audio(&services, &session_id, &data, &mut sender).await
                             {
                                 Ok(_) => {
                                     info!("Successfully processed raw audio");
@@ -1285,3 +1329,51 @@ async fn handle_raw_audio(
     info!("=== Raw audio processing completed ===");
     Ok(())
 }
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_split_bp3_single_frame() {
+        let data = frame_bp3(&[1, 2, 3]).unwrap();
+        let frames = split_bp3_frames(&data).unwrap();
+        assert_eq!(frames, vec![&[1u8, 2, 3][..]]);
+    }
+
+    #[test]
+    fn test_split_bp3_batched_frames() {
+        let mut data = frame_bp3(&[1, 2, 3]).unwrap();
+        data.extend(frame_bp3(&[4, 5]).unwrap());
+        let frames = split_bp3_frames(&data).unwrap();
+        assert_eq!(frames, vec![&[1u8, 2, 3][..], &[4u8, 5][..]]);
+    }
+
+    #[test]
+    fn test_split_bp3_rejects_raw_data() {
+        // Сырой Opus пакет без заголовка
+        assert!(split_bp3_frames(&[0x78, 0x01, 0x02, 0x03, 0x04]).is_none());
+        // Обрезанный хвост после корректного фрейма
+        let mut data = frame_bp3(&[1, 2]).unwrap();
+        data.extend_from_slice(&[0, 0, 0, 9, 1]);
+        assert!(split_bp3_frames(&data).is_none());
+    }
+
+    #[test]
+    fn test_decode_bp3_packets_skips_bad_packet() {
+        use crate::utils::audio::OPUS_FRAME_SIZE;
+        use crate::websocket::audio::AudioProcessingParams;
+
+        let mut processor = AudioProcessor::new(AudioProcessingParams::default()).unwrap();
+        let good = processor
+            .process_outgoing_audio(&vec![0i16; OPUS_FRAME_SIZE])
+            .unwrap();
+        // TOC 0xFF + счетчик 63 кадра по 20 мс - невалидный Opus пакет
+        let bad: &[u8] = &[0xFF, 0xFF, 0xFF];
+
+        let pcm = decode_bp3_packets(&mut processor, &[&good[..], bad, &good[..]]);
+        assert_eq!(pcm.len(), 2 * OPUS_FRAME_SIZE);
+
+        assert!(decode_bp3_packets(&mut processor, &[bad]).is_empty());
+    }
+}